@@ -4,88 +4,454 @@ Image Generator using Imagen 04 Ultra
 Generates NUSMods timetable wallpapers using Google's Imagen text-to-image model.
 """
 
-import base64
+import hashlib
 import io
 import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Optional
+try:
+    import pybase64 as _base64
+except ImportError:
+    import base64 as _base64
 from google import genai
 from google.genai import types
+import google.auth
+import google.auth.transport.requests
+from google.api_core import exceptions as gcloud_exceptions
+from google.cloud import storage
 
 # Set up logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+GCP_PROJECT = "modpocket-369"
+GCP_LOCATION = "us-central1"
+IMAGEN_MODEL = "imagen-4.0-ultra-generate-001"
 
-def stylize_timetable(source_image: bytes, prompt: str, aspect_ratio: str = "9:16") -> bytes:
+# Upper bound per Imagen call, kept below the 120s function timeout so a hung
+# request frees its pooled connection instead of holding it until the kill.
+IMAGEN_TIMEOUT_MS = 100_000
+
+# Models tried in order; only Imagen 4.0 Ultra is enabled for now.
+IMAGEN_MODELS: tuple[str, ...] = (IMAGEN_MODEL,)
+# When set, all IMAGEN_MODELS are requested at once and the first image wins.
+# Off by default since every raced model is billed.
+IMAGEN_RACE_MODELS = os.environ.get("IMAGEN_RACE_MODELS", "0") == "1"
+
+# Generated wallpapers are cached by prompt hash: a small in-process LRU for
+# warm instances, backed by a GCS bucket shared across instances.
+IMAGE_CACHE_BUCKET = os.environ.get("IMAGE_CACHE_BUCKET", "modpocket-imgcache")
+# Cache calls run with retry=None so these timeouts bound the whole call, not
+# each attempt. A false miss costs a billed Imagen call of 10s or more, and the
+# bucket may sit outside the function's region, so lookups get a generous budget.
+IMAGE_CACHE_TIMEOUT_SEC = 1.5
+# Uploads are best-effort and happen after waiters are released, but the
+# owning request still pays for them, so keep them well inside the timeout.
+IMAGE_CACHE_UPLOAD_TIMEOUT_SEC = 5
+SIGNED_URL_TTL = timedelta(hours=1)
+LOCAL_IMAGE_CACHE_SIZE = 64
+
+_local_image_cache: "OrderedDict[str, bytes]" = OrderedDict()
+_local_image_cache_lock = threading.Lock()
+
+# Generations currently running on this instance, keyed by cache key, so that
+# identical concurrent requests wait on one Imagen call instead of each paying
+# for their own. Waiters give up shortly before the function timeout.
+INFLIGHT_WAIT_TIMEOUT_SEC = 110
+_inflight: dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+
+# Clients are created on first use and then shared by every request served by
+# this instance, across threads: the client's connection pool is thread-safe,
+# so keep-alive connections are reused. They are not built at import time
+# because the Firebase CLI imports this module during deploy, where
+# credentials may be unavailable.
+_client: Optional[genai.Client] = None
+_cache_bucket: Optional[storage.Bucket] = None
+_signing_credentials = None
+_client_lock = threading.Lock()
+
+_generate_configs: dict[tuple[str, str, str], types.GenerateImagesConfig] = {}
+
+
+def _get_client() -> genai.Client:
+    """Return the shared Vertex AI client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                logger.info("Initializing Imagen client")
+                _client = genai.Client(
+                    vertexai=True,
+                    project=GCP_PROJECT,
+                    location=GCP_LOCATION,
+                    http_options=types.HttpOptions(timeout=IMAGEN_TIMEOUT_MS),
+                )
+    return _client
+
+
+def _get_cache_bucket() -> storage.Bucket:
+    """Return the shared image cache bucket handle, creating it on first use."""
+    global _cache_bucket
+    if _cache_bucket is None:
+        with _client_lock:
+            if _cache_bucket is None:
+                _cache_bucket = storage.Client().bucket(IMAGE_CACHE_BUCKET)
+    return _cache_bucket
+
+
+def warm_up() -> None:
     """
-    Generate a timetable wallpaper using Imagen text-to-image model.
+    Eagerly create the shared clients so the first request skips credential
+    discovery. Failures are logged and left for the request path to retry.
+    """
+    try:
+        _get_client()
+        _get_cache_bucket()
+        _generate_config("9:16")
+    except Exception as e:
+        logger.warning(f"Imagen warm-up failed: {type(e).__name__}: {str(e)}")
+
+
+def _generate_config(
+    aspect_ratio: str,
+    safety_filter_level: str = "block_some",
+    person_generation: str = "allow_all",
+) -> types.GenerateImagesConfig:
+    """Return a memoized GenerateImagesConfig for the given options."""
+    key = (aspect_ratio, safety_filter_level, person_generation)
+    config = _generate_configs.get(key)
+    if config is None:
+        config = types.GenerateImagesConfig(
+            number_of_images=1,
+            aspect_ratio=aspect_ratio,
+            safety_filter_level=safety_filter_level,
+            person_generation=person_generation,
+        )
+        _generate_configs[key] = config
+    return config
+
+
+def _prompt_cache_key(prompt: str, model: str, aspect_ratio: str) -> str:
+    """
+    Build a deterministic cache key for a generation request.
+    
+    The prompt is canonicalized (trailing whitespace stripped per line) so that
+    cosmetic template changes do not invalidate otherwise identical images.
+    """
+    canonical_prompt = "\n".join(line.rstrip() for line in prompt.strip().splitlines())
+    payload = f"{model}\n{aspect_ratio}\n{canonical_prompt}".encode("utf-8")
+    return hashlib.blake2b(payload).hexdigest()[:32]
+
+
+def _remember_image(key: str, image_bytes: bytes) -> None:
+    """Store image bytes in the process-local LRU cache."""
+    with _local_image_cache_lock:
+        _local_image_cache[key] = image_bytes
+        _local_image_cache.move_to_end(key)
+        while len(_local_image_cache) > LOCAL_IMAGE_CACHE_SIZE:
+            _local_image_cache.popitem(last=False)
+
+
+def _load_local_image(key: str) -> Optional[bytes]:
+    """Look up a previously generated image in the process-local LRU cache."""
+    with _local_image_cache_lock:
+        image_bytes = _local_image_cache.get(key)
+        if image_bytes is not None:
+            _local_image_cache.move_to_end(key)
+        return image_bytes
+
+
+def _load_cached_image(key: str) -> Optional[bytes]:
+    """
+    Look up a previously generated image, first in memory then in GCS.
+    
+    Returns:
+        Cached PNG bytes, or None on a miss (or if the cache is unreachable)
+    """
+    image_bytes = _load_local_image(key)
+    if image_bytes is not None:
+        return image_bytes
+    
+    try:
+        blob = _get_cache_bucket().blob(f"{key}.png")
+        image_bytes = blob.download_as_bytes(timeout=IMAGE_CACHE_TIMEOUT_SEC, retry=None)
+    except gcloud_exceptions.NotFound:
+        return None
+    except Exception as e:
+        logger.warning(f"Image cache lookup failed for {key}: {str(e)}")
+        return None
+    
+    _remember_image(key, image_bytes)
+    return image_bytes
+
+
+def _store_cached_image(key: str, image_bytes: bytes) -> None:
+    """Persist a generated image to GCS. Failures are non-fatal."""
+    try:
+        blob = _get_cache_bucket().blob(f"{key}.png")
+        blob.upload_from_string(
+            image_bytes, content_type="image/png",
+            timeout=IMAGE_CACHE_UPLOAD_TIMEOUT_SEC, retry=None,
+        )
+    except Exception as e:
+        logger.warning(f"Image cache write failed for {key}: {str(e)}")
+
+
+def _generate_with_model(model_name: str, prompt: str, aspect_ratio: str) -> Optional[bytes]:
+    """
+    Run a single Imagen generation.
+    
+    Returns:
+        Generated image bytes, or None if the model responded without an image
+    """
+    logger.info(f"Attempting to use model: {model_name}")
+    
+    # Generate image from text prompt
+    response = _get_client().models.generate_images(
+        model=model_name,
+        prompt=prompt,
+        config=_generate_config(aspect_ratio)
+    )
+    
+    logger.info(f"Successfully generated image with {model_name}")
+    
+    # Extract the generated image
+    if response.generated_images and len(response.generated_images) > 0:
+        return response.generated_images[0].image.image_bytes
+    
+    logger.warning(f"Model {model_name} returned response but no image data")
+    return None
+
+
+def _generate_sequentially(models: tuple[str, ...], prompt: str, aspect_ratio: str) -> bytes:
+    """Try each model in order, falling back to the next only on failure."""
+    last_error = None
+    for model_name in models:
+        try:
+            image_data = _generate_with_model(model_name, prompt, aspect_ratio)
+        except Exception as model_error:
+            logger.warning(f"Model {model_name} failed: {str(model_error)}")
+            last_error = model_error
+            continue
+        
+        if image_data:
+            return image_data
+        break  # Don't try other models if this one responded
+    
+    # If we got here, either no image was generated or all models failed
+    if last_error:
+        raise ValueError(f"All Imagen models failed. Last error: {str(last_error)}")
+    raise ValueError("Imagen did not generate an image. Please try again.")
+
+
+def _generate_racing(models: tuple[str, ...], prompt: str, aspect_ratio: str) -> bytes:
+    """
+    Request all models concurrently and return the first image produced.
+    
+    Requests still in flight when a winner arrives are abandoned; Imagen calls
+    cannot be interrupted, so they run to completion in the background.
+    """
+    executor = ThreadPoolExecutor(max_workers=len(models))
+    futures = {
+        executor.submit(_generate_with_model, model_name, prompt, aspect_ratio): model_name
+        for model_name in models
+    }
+    last_error = None
+    try:
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    image_data = future.result()
+                except Exception as model_error:
+                    logger.warning(f"Model {futures[future]} failed: {str(model_error)}")
+                    last_error = model_error
+                    continue
+                if image_data:
+                    return image_data
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    if last_error:
+        raise ValueError(f"All Imagen models failed. Last error: {str(last_error)}")
+    raise ValueError("Imagen did not generate an image. Please try again.")
+
+
+def _generate_image(
+    cache_key: str,
+    prompt: str,
+    aspect_ratio: str,
+    store_in_gcs: bool = True,
+) -> bytes:
+    """
+    Return the image for cache_key from the local LRU, an identical in-flight
+    generation, or a new Imagen call. The GCS cache is not read here.
     
     Args:
-        source_image: Source timetable image bytes (not used with Imagen, kept for API compatibility)
+        cache_key: Key from _prompt_cache_key for this prompt and aspect ratio
         prompt: Text prompt describing the timetable wallpaper to generate
         aspect_ratio: Target aspect ratio (e.g., "9:16", "9:19.5", "9:20", "9:21")
+        store_in_gcs: Upload a newly generated image to the GCS cache (best-effort).
+            Callers that upload it themselves pass False.
     
     Returns:
         Generated image bytes (PNG format)
     """
+    cached_image = _load_local_image(cache_key)
+    if cached_image is not None:
+        logger.info(f"Image cache hit ({cache_key}): {len(cached_image)} bytes")
+        return cached_image
+    
+    # Coalesce concurrent identical requests onto a single Imagen call
+    with _inflight_lock:
+        inflight = _inflight.get(cache_key)
+        is_owner = inflight is None
+        if is_owner:
+            inflight = Future()
+            _inflight[cache_key] = inflight
+    
+    if not is_owner:
+        logger.info(f"Waiting for in-flight generation ({cache_key})")
+        return inflight.result(timeout=INFLIGHT_WAIT_TIMEOUT_SEC)
+    
     try:
-        logger.info("Initializing Imagen client")
-        # Initialize client with Vertex AI
-        client = genai.Client(
-            vertexai=True,
-            project="modpocket-369",
-            location="us-central1"
-        )
-        
         logger.info(f"Generating image with Imagen from text prompt ({len(prompt)} characters)")
         
-        # Try only Imagen 4.0 Ultra as requested
-        models_to_try = [
-            "imagen-4.0-ultra-generate-001",
-        ]
-        
-        last_error = None
-        for model_name in models_to_try:
-            try:
-                logger.info(f"Attempting to use model: {model_name}")
-                
-                # Generate image from text prompt
-                response = client.models.generate_images(
-                    model=model_name,
-                    prompt=prompt,
-                    config=types.GenerateImagesConfig(
-                        number_of_images=1,
-                        aspect_ratio=aspect_ratio,  # Use provided aspect ratio
-                        safety_filter_level="block_some",
-                        person_generation="allow_all",
-                    )
-                )
-                
-                logger.info(f"Successfully generated image with {model_name}")
-                
-                # Extract the generated image
-                if response.generated_images and len(response.generated_images) > 0:
-                    image_data = response.generated_images[0].image.image_bytes
-                    logger.info(f"Image generated successfully: {len(image_data)} bytes")
-                    return image_data
-                
-                # If we get here, no image was in the response
-                logger.warning(f"Model {model_name} returned response but no image data")
-                break  # Don't try other models if this one responded
-                
-            except Exception as model_error:
-                logger.warning(f"Model {model_name} failed: {str(model_error)}")
-                last_error = model_error
-                continue
-        
-        # If we got here, either no image was generated or all models failed
-        if last_error:
-            raise ValueError(f"All Imagen models failed. Last error: {str(last_error)}")
+        if IMAGEN_RACE_MODELS and len(IMAGEN_MODELS) > 1:
+            image_data = _generate_racing(IMAGEN_MODELS, prompt, aspect_ratio)
         else:
-            raise ValueError("Imagen did not generate an image. Please try again.")
+            image_data = _generate_sequentially(IMAGEN_MODELS, prompt, aspect_ratio)
+        
+        logger.info(f"Image generated successfully: {len(image_data)} bytes")
+        # Release coalesced waiters before the (slower) GCS upload
+        _remember_image(cache_key, image_data)
+        inflight.set_result(image_data)
+        if store_in_gcs:
+            _store_cached_image(cache_key, image_data)
+        return image_data
             
     except Exception as e:
-        logger.error(f"Error in stylize_timetable: {type(e).__name__}: {str(e)}")
+        logger.error(f"Error generating image ({cache_key}): {type(e).__name__}: {str(e)}")
+        inflight.set_exception(e)
         raise
+    
+    finally:
+        with _inflight_lock:
+            _inflight.pop(cache_key, None)
+
+
+def stylize_timetable(source_image: bytes, prompt: str, aspect_ratio: str = "9:16") -> bytes:
+    """
+    Generate a timetable wallpaper using Imagen text-to-image model.
+    Identical requests are served from the image cache without calling Imagen.
+    
+    Args:
+        source_image: Source timetable image bytes (not used with Imagen, kept for API compatibility)
+        prompt: Text prompt describing the timetable wallpaper to generate
+        aspect_ratio: Target aspect ratio (e.g., "9:16", "9:19.5", "9:20", "9:21")
+    
+    Returns:
+        Generated image bytes (PNG format)
+    """
+    cache_key = _prompt_cache_key(prompt, IMAGEN_MODEL, aspect_ratio)
+    cached_image = _load_cached_image(cache_key)
+    if cached_image is not None:
+        logger.info(f"Image cache hit ({cache_key}): {len(cached_image)} bytes")
+        return cached_image
+    
+    return _generate_image(cache_key, prompt, aspect_ratio)
+
+
+def generate_image_bytes(prompt: str, aspect_ratio: str = "9:16") -> bytes:
+    """
+    Generate a wallpaper and return the raw PNG bytes.
+    
+    Args:
+        prompt: Text prompt describing the timetable wallpaper to generate
+        aspect_ratio: Target aspect ratio (e.g., "9:16", "9:19.5", "9:20", "9:21")
+    
+    Returns:
+        PNG image bytes
+    """
+    return stylize_timetable(b"", prompt, aspect_ratio)
+
+
+def _get_signing_credentials():
+    """
+    Return refreshed default credentials for V4 URL signing.
+    
+    Cloud Functions credentials carry no private key, so signing goes through
+    the IAM signBlob API using the service account email and access token.
+    """
+    global _signing_credentials
+    with _client_lock:
+        if _signing_credentials is None:
+            _signing_credentials, _ = google.auth.default()
+        if not _signing_credentials.valid:
+            _signing_credentials.refresh(google.auth.transport.requests.Request())
+        return _signing_credentials
+
+
+def _cached_blob_exists(blob: storage.Blob) -> bool:
+    """Check whether a cached image is in GCS; an unreachable cache counts as a miss."""
+    try:
+        return blob.exists(timeout=IMAGE_CACHE_TIMEOUT_SEC, retry=None)
+    except Exception as e:
+        logger.warning(f"Image cache existence check failed for {blob.name}: {str(e)}")
+        return False
+
+
+def generate_image_url(prompt: str, aspect_ratio: str = "9:16") -> str:
+    """
+    Generate a wallpaper (or reuse a cached one) and return a signed GCS URL.
+    
+    The image cache bucket doubles as the delivery store, so a cache hit only
+    costs an existence check and the URL signing; the image bytes never pass
+    through the function.
+    
+    Args:
+        prompt: Text prompt describing the timetable wallpaper to generate
+        aspect_ratio: Target aspect ratio (e.g., "9:16", "9:19.5", "9:20", "9:21")
+    
+    Returns:
+        V4 signed URL to the PNG, valid for SIGNED_URL_TTL
+    """
+    cache_key = _prompt_cache_key(prompt, IMAGEN_MODEL, aspect_ratio)
+    blob = _get_cache_bucket().blob(f"{cache_key}.png")
+    
+    if _cached_blob_exists(blob):
+        logger.info(f"Image cache hit ({cache_key}): signing URL")
+    else:
+        # exists() already missed in GCS, so skip the GCS read. The URL is
+        # useless without the object, so upload here rather than best-effort,
+        # and let failures propagate.
+        image_bytes = _generate_image(cache_key, prompt, aspect_ratio, store_in_gcs=False)
+        blob.upload_from_string(
+            image_bytes, content_type="image/png",
+            timeout=IMAGE_CACHE_UPLOAD_TIMEOUT_SEC, retry=None,
+        )
+    
+    credentials = _get_signing_credentials()
+    return blob.generate_signed_url(
+        version="v4",
+        expiration=SIGNED_URL_TTL,
+        method="GET",
+        service_account_email=credentials.service_account_email,
+        access_token=credentials.token,
+    )
+
+
+def encode_image_base64(image_bytes: bytes) -> str:
+    """Base64-encode image bytes, using SIMD-accelerated pybase64 when available."""
+    if hasattr(_base64, "b64encode_as_string"):
+        return _base64.b64encode_as_string(image_bytes)
+    return _base64.b64encode(image_bytes).decode("ascii")
 
 
 def generate_image_base64(source_image: bytes, prompt: str, aspect_ratio: str = "9:16") -> str:
@@ -101,4 +467,4 @@ def generate_image_base64(source_image: bytes, prompt: str, aspect_ratio: str =
         Base64-encoded PNG image string
     """
     image_bytes = stylize_timetable(source_image, prompt, aspect_ratio)
-    return base64.b64encode(image_bytes).decode("utf-8")
+    return encode_image_base64(image_bytes)
@@ -6,16 +6,37 @@ Uses static timetable data from assets/timetable.txt.
 """
 
 import os
+import re
+import sys
 import json
+import time
 import logging
-import traceback
 import firebase_admin
+from concurrent.futures import ThreadPoolExecutor, wait
 from firebase_functions import https_fn
 from firebase_functions.options import set_global_options, CorsOptions
-from typing import Dict, List, TypedDict
+from typing import Dict, List, Tuple, TypedDict, get_args
 
-from prompt_builder import build_prompt, DesignStyleType, ThemeType
-from image_generator import generate_image_base64
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+    _json_loads = json.loads
+
+try:
+    import pybase64 as _base64
+except ImportError:
+    import base64 as _base64
+
+from prompt_builder import build_prompt, build_prompts_batch, DesignStyleType, ThemeType
+from image_generator import (
+    generate_image_bytes,
+    generate_image_url,
+    warm_up,
+)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -23,11 +44,37 @@ logger.setLevel(logging.INFO)
 firebase_admin.initialize_app()
 set_global_options(max_instances=10)
 
-VALID_STYLES = ("minimalist", "gradient", "neon", "pastel", "glass", "retro", "kawaii")
-VALID_THEMES = ("light", "dark")
+# Accepted values come from the prompt_builder Literal types, the single source of truth
+STYLE_NAMES = get_args(DesignStyleType)
+VALID_STYLES = frozenset(STYLE_NAMES)
+THEME_NAMES = get_args(ThemeType)
+VALID_THEMES = frozenset(THEME_NAMES)
 CORE_ASPECT_RATIO = "9:16"
+INVALID_STYLE_ERROR = f"Invalid design_style. Use one of: {', '.join(STYLE_NAMES)}."
+INVALID_THEME_ERROR = f"Invalid theme. Use {' or '.join(repr(t) for t in THEME_NAMES)}."
 DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
 
+# Style previews: every (design_style, theme) pair for the static timetable.
+# Imagen calls are bounded to stay within the per-minute quota. A variant is
+# only started if it can finish within the budget (worst case: the 100s Imagen
+# timeout plus the GCS check, upload and URL signing); later ones are reported
+# as failed instead of holding the response past the function timeout.
+PREVIEW_VARIANTS = tuple((style, theme) for style in STYLE_NAMES for theme in THEME_NAMES)
+PREVIEW_MAX_CONCURRENCY = 4
+PREVIEW_TIMEOUT_SEC = 300
+PREVIEW_TIME_BUDGET_SEC = 270
+PREVIEW_VARIANT_MAX_SEC = 115
+PREVIEW_ERROR = "No style previews could be generated. Please try again."
+
+# timetable.txt entries are separated by blank lines. Each one starts with
+# "<module> [<lesson type>]" / "<venue>" / "<day> <HHMM>-<HHMM>"; any further
+# lines in an entry are ignored.
+TIMETABLE_SEPARATOR_RE = re.compile(r"\n[ \t]*\n\s*")
+TIMETABLE_ENTRY_RE = re.compile(
+    r"(\S+)[ \t]*(.*)\n(.+)\n(\S+)[ \t]+(\d{4})-(\d{4})[ \t]*$",
+    re.MULTILINE,
+)
+
 
 class EnrichedLesson(TypedDict):
     day: str
@@ -38,56 +85,65 @@ class EnrichedLesson(TypedDict):
     classNo: str
 
 
-def load_static_timetable() -> Dict[str, List[EnrichedLesson]]:
+def _parse_timetable_file() -> Tuple[Dict[str, List[EnrichedLesson]], int]:
     """
-    Load timetable from assets/timetable.txt.
+    Parse assets/timetable.txt. Called once at import; see _STATIC_SCHEDULE.
     Format per entry (3 lines + blank):
         MA1521 Lecture
         LT32
         Monday 0800-1000
+    Entries without a valid "Day HHMM-HHMM" line are skipped with a warning.
+    
+    Returns:
+        Tuple of (schedule keyed by module code, total number of lessons)
     """
     timetable_path = os.path.join(os.path.dirname(__file__), "assets", "timetable.txt")
     
-    with open(timetable_path, "r") as f:
-        content = f.read().strip()
+    with open(timetable_path, "r", newline="") as f:
+        # Normalize line endings so a CRLF-saved file parses the same
+        content = f.read().replace("\r\n", "\n").replace("\r", "\n").strip()
     
-    entries = content.split("\n\n")
+    entries = TIMETABLE_SEPARATOR_RE.split(content) if content else []
     schedule: Dict[str, List[EnrichedLesson]] = {}
+    total_lessons = 0
     
     for entry in entries:
-        lines = entry.strip().split("\n")
-        if len(lines) < 3:
+        match = TIMETABLE_ENTRY_RE.match(entry)
+        if match is None:
             continue
+        module_code, lesson_type, venue, day, start_time, end_time = match.groups()
         
-        # Parse: "MA1521 Lecture" -> module="MA1521", type="Lecture"
-        first_line_parts = lines[0].split(" ", 1)
-        module_code = first_line_parts[0]
-        lesson_type = first_line_parts[1] if len(first_line_parts) > 1 else "Class"
-        
-        venue = lines[1]
-        
-        # Parse: "Monday 0800-1000" -> day="Monday", time="0800-1000"
-        day_time_parts = lines[2].split(" ")
-        day = day_time_parts[0]
-        time_range = day_time_parts[1] if len(day_time_parts) > 1 else "0000-0000"
-        start_time, end_time = time_range.split("-")
-        
+        # Days, venues and lesson types repeat across entries; intern them
+        # so the schedule holds a single copy of each distinct value
         lesson = EnrichedLesson(
-            day=day,
+            day=sys.intern(day),
             startTime=start_time,
             endTime=end_time,
-            venue=venue,
-            lessonType=lesson_type,
+            venue=sys.intern(venue),
+            lessonType=sys.intern(lesson_type or "Class"),
             classNo="1"
         )
-        
-        if module_code not in schedule:
-            schedule[module_code] = []
-        schedule[module_code].append(lesson)
-        
-        logger.info(f"Loaded: {module_code} {lesson_type} on {day} {start_time}-{end_time} @ {venue}")
+        schedule.setdefault(module_code, []).append(lesson)
+        total_lessons += 1
     
-    return schedule
+    if total_lessons != len(entries):
+        logger.warning(
+            "Skipped %d of %d timetable entries without a valid \"Day HHMM-HHMM\" line",
+            len(entries) - total_lessons, len(entries)
+        )
+    logger.info("Loaded static timetable: %d lessons for %d modules", total_lessons, len(schedule))
+    return schedule, total_lessons
+
+
+# The timetable asset is static per deploy, so parse it once per instance
+_STATIC_SCHEDULE, _STATIC_LESSON_COUNT = _parse_timetable_file()
+_STATIC_MODULE_CODES = list(_STATIC_SCHEDULE.keys())
+_STATIC_MODULES_JSON = _json_dumps(_STATIC_MODULE_CODES)
+
+# Pay client setup during cold start rather than on the first request.
+# K_SERVICE is only set in the deployed runtime, not during `firebase deploy`.
+if os.environ.get("K_SERVICE"):
+    warm_up()
 
 
 @https_fn.on_request(
@@ -100,59 +156,183 @@ def generate_wallpaper(req: https_fn.Request) -> https_fn.Response:
     """
     Generate a stylized timetable wallpaper.
     Uses static timetable from assets/timetable.txt.
+    
+    Responds with JSON (base64 image) by default, with the raw PNG when the
+    request sends `Accept: image/png`, or with a signed GCS URL when the body
+    sets `"response_format": "url"`.
     """
     if req.method != "POST":
         return https_fn.Response(
-            json.dumps({"error": "Method not allowed. Use POST."}),
+            _json_dumps({"error": "Method not allowed. Use POST."}),
             status=405, content_type="application/json"
         )
     
     try:
-        body = req.get_json(force=True)
+        body = _json_loads(req.get_data())
     except Exception:
         body = {}
     
     design_style: DesignStyleType = body.get("design_style", "minimalist").lower()
     theme: ThemeType = body.get("theme", "light").lower()
     
+    errors = []
     if design_style not in VALID_STYLES:
-        return https_fn.Response(
-            json.dumps({"error": f"Invalid design_style. Use one of: {', '.join(VALID_STYLES)}"}),
-            status=400, content_type="application/json"
-        )
-    
+        errors.append(INVALID_STYLE_ERROR)
     if theme not in VALID_THEMES:
+        errors.append(INVALID_THEME_ERROR)
+    if errors:
         return https_fn.Response(
-            json.dumps({"error": "Invalid theme. Use 'light' or 'dark'."}),
+            _json_dumps({"error": " ".join(errors)}),
             status=400, content_type="application/json"
         )
     
     try:
-        logger.info(f"Generating wallpaper: style={design_style}, theme={theme}")
+        logger.info("Generating wallpaper: style=%s, theme=%s", design_style, theme)
         
         # Step 1: Load static timetable
-        schedule = load_static_timetable()
-        module_codes = list(schedule.keys())
-        total_lessons = sum(len(l) for l in schedule.values())
-        logger.info(f"Loaded {total_lessons} lessons for {len(module_codes)} modules")
+        schedule = _STATIC_SCHEDULE
+        logger.info("Loaded %d lessons for %d modules", _STATIC_LESSON_COUNT, len(schedule))
         
         # Step 2: Build prompt
         prompt = build_prompt(design_style, theme, CORE_ASPECT_RATIO, schedule)
-        logger.info(f"Prompt built: {len(prompt)} chars")
+        logger.info("Prompt built: %d chars", len(prompt))
         
         # Step 3: Generate image
-        image_base64 = generate_image_base64(b"", prompt, CORE_ASPECT_RATIO)
-        logger.info(f"Image generated: {len(image_base64)} base64 chars")
+        if body.get("response_format") == "url":
+            image_url = generate_image_url(prompt, CORE_ASPECT_RATIO)
+            logger.info("Image available at signed URL")
+            return https_fn.Response(
+                _json_dumps({"success": True, "image_url": image_url, "modules": _STATIC_MODULE_CODES}),
+                status=200, content_type="application/json"
+            )
+        
+        image_bytes = generate_image_bytes(prompt, CORE_ASPECT_RATIO)
+        logger.info("Image generated: %d bytes", len(image_bytes))
+        
+        # Clients that accept PNG get the raw image, skipping base64 entirely
+        if req.accept_mimetypes.best_match(("application/json", "image/png")) == "image/png":
+            return https_fn.Response(
+                image_bytes,
+                status=200, content_type="image/png",
+                headers={
+                    "X-Modules": ",".join(_STATIC_MODULE_CODES),
+                    "Access-Control-Expose-Headers": "X-Modules",
+                }
+            )
         
+        # b64encode returns ASCII bytes that need no escaping, so splice them in
+        # directly rather than decoding to str or re-scanning the whole payload
+        response_body = b"".join((
+            b'{"success":true,"modules":',
+            _STATIC_MODULES_JSON,
+            b',"image_base64":"',
+            _base64.b64encode(image_bytes),
+            b'"}',
+        ))
         return https_fn.Response(
-            json.dumps({"success": True, "image_base64": image_base64, "modules": module_codes}),
+            response_body,
             status=200, content_type="application/json"
         )
         
     except Exception as e:
-        logger.error(f"Error: {type(e).__name__}: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Unexpected error while generating wallpaper")
         return https_fn.Response(
-            json.dumps({"error": f"Internal error: {str(e)}"}),
+            _json_dumps({"error": f"Internal error: {str(e)}"}),
             status=500, content_type="application/json"
-        )
\ No newline at end of file
+        )
+
+
+def _generate_style_previews() -> Tuple[Dict[str, str], List[str]]:
+    """
+    Generate a signed-URL preview of the static timetable in every style.
+    
+    Prompts are built in one batch so the schedule is formatted once. Each
+    variant succeeds or fails on its own, so one safety-filtered style does
+    not discard the rest.
+    
+    Returns:
+        Tuple of (signed URL keyed by "<style>_<theme>", failed variant names)
+    """
+    prompts = build_prompts_batch([
+        (style, theme, CORE_ASPECT_RATIO, _STATIC_SCHEDULE)
+        for style, theme in PREVIEW_VARIANTS
+    ])
+    
+    deadline = time.monotonic() + PREVIEW_TIME_BUDGET_SEC
+    
+    def preview_url(prompt: str) -> str:
+        # Cloud Run throttles CPU once the response is sent, so work that could
+        # outlive the budget is never started rather than left running
+        if time.monotonic() + PREVIEW_VARIANT_MAX_SEC > deadline:
+            raise TimeoutError("not started, would not finish within the preview budget")
+        return generate_image_url(prompt, CORE_ASPECT_RATIO)
+    
+    executor = ThreadPoolExecutor(max_workers=PREVIEW_MAX_CONCURRENCY)
+    futures = {
+        executor.submit(preview_url, prompt): f"{style}_{theme}"
+        for (style, theme), prompt in zip(PREVIEW_VARIANTS, prompts)
+    }
+    done, _ = wait(futures, timeout=PREVIEW_TIME_BUDGET_SEC)
+    # Every started variant is bounded by PREVIEW_VARIANT_MAX_SEC, so nothing
+    # should still be pending here. Anything that is anyway is abandoned: it
+    # may not complete once the response is sent, and is reported as failed.
+    executor.shutdown(wait=False, cancel_futures=True)
+    
+    previews: Dict[str, str] = {}
+    failed: List[str] = []
+    for future, name in futures.items():
+        if future not in done:
+            logger.warning("Preview %s did not finish within %ds", name, PREVIEW_TIME_BUDGET_SEC)
+            failed.append(name)
+        elif future.exception() is not None:
+            logger.warning("Preview %s failed: %s", name, future.exception())
+            failed.append(name)
+        else:
+            previews[name] = future.result()
+    
+    logger.info("Generated %d of %d style previews", len(previews), len(futures))
+    return previews, failed
+
+
+@https_fn.on_request(
+    region="asia-southeast1",
+    memory=512,
+    timeout_sec=PREVIEW_TIMEOUT_SEC,
+    cors=CorsOptions(cors_origins="*", cors_methods=["POST", "OPTIONS"])
+)
+def generate_style_previews(req: https_fn.Request) -> https_fn.Response:
+    """
+    Generate the static timetable in every design style and theme.
+    
+    Responds with a signed GCS URL per variant; variants that failed or could
+    not finish within PREVIEW_TIME_BUDGET_SEC are listed under "failed".
+    """
+    if req.method != "POST":
+        return https_fn.Response(
+            _json_dumps({"error": "Method not allowed. Use POST."}),
+            status=405, content_type="application/json"
+        )
+    
+    try:
+        previews, failed = _generate_style_previews()
+        if not previews:
+            return https_fn.Response(
+                _json_dumps({"error": PREVIEW_ERROR, "failed": failed}),
+                status=500, content_type="application/json"
+            )
+        return https_fn.Response(
+            _json_dumps({
+                "success": True,
+                "previews": previews,
+                "failed": failed,
+                "modules": _STATIC_MODULE_CODES,
+            }),
+            status=200, content_type="application/json"
+        )
+        
+    except Exception as e:
+        logger.exception("Unexpected error while generating style previews")
+        return https_fn.Response(
+            _json_dumps({"error": f"Internal error: {str(e)}"}),
+            status=500, content_type="application/json"
+        )
@@ -4,13 +4,24 @@ NUSMods URL Parser and API Integration
 Parses NUSMods share URLs and enriches schedule data with NUSMods API.
 """
 
-import re
+import sys
 import json
+import time
+import functools
 import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qsl
 from typing import TypedDict, Optional, List, Dict
 import requests
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 logger = logging.getLogger(__name__)
@@ -30,15 +41,50 @@ LESSON_TYPE_MAPPING = {
     "WS": "Workshop",
     "DOM": "Design Lecture",
     "MCT": "Mini-Project",
+    "DLEC": "Design Lecture",
+    "PLEC": "Packaged Lecture",
+    "PTUT": "Packaged Tutorial",
+    "TUT2": "Tutorial Type 2",
+    "TUT3": "Tutorial Type 3",
     # Add common variations just in case
     "LECTURE": "Lecture",
     "TUTORIAL": "Tutorial",
     "LABORATORY": "Laboratory",
 }
 
+# Shared session so concurrent module fetches reuse pooled keep-alive
+# connections to api.nusmods.com, with backoff on transient failures.
+# Module JSON compresses well; requests already sends "Accept-Encoding: gzip, deflate".
+HTTP_POOL_SIZE = 16
+
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=HTTP_POOL_SIZE,
+    pool_maxsize=HTTP_POOL_SIZE,
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.2,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=("GET",),
+    ),
+))
+
+# Long-lived worker threads for module fetches, shared by all requests on this
+# instance instead of spinning up a new pool per enrichment
+_FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix="nusmods-fetch")
+
+# Module JSON is cached in-process; timetables change rarely within a day
+MODULE_CACHE_SIZE = 512
+MODULE_CACHE_TTL_SEC = 24 * 60 * 60
+
+# (academic year, monotonic timestamp) of the last get_current_academic_year call
+ACADEMIC_YEAR_CACHE_SEC = 60 * 60
+_academic_year_cache: Optional[tuple[str, float]] = None
+
 class ParsedUrl(TypedDict):
     semester: int
-    modules: dict[str, dict[str, list[str]]]  # Changed int to str for class numbers
+    # module code -> uppercase URL lesson type (e.g. "LEC") -> class numbers
+    modules: dict[str, dict[str, list[str]]]
 
 
 class EnrichedLesson(TypedDict):
@@ -53,6 +99,14 @@ class EnrichedLesson(TypedDict):
 EnrichedSchedule = Dict[str, List[EnrichedLesson]]
 
 
+def _normalize_class_no(class_no: str) -> str:
+    """
+    Canonical form of a class number for matching, so that "01" and "1" are equal.
+    Non-numeric class numbers (e.g. "A1") are returned unchanged.
+    """
+    return str(int(class_no)) if class_no.isdecimal() else class_no
+
+
 def parse_nusmods_url(url: str) -> ParsedUrl:
     """
     Parse a NUSMods share URL and extract semester and module selections.
@@ -61,37 +115,38 @@ def parse_nusmods_url(url: str) -> ParsedUrl:
     https://nusmods.com/timetable/sem-2/share?BT2102=LAB:(7);LEC:(11)&CS2040=TUT:(33);LAB:(20);LEC:(34,35)
     
     Returns:
-        ParsedUrl with semester and modules dict (lesson types with class numbers as lists)
+        ParsedUrl with semester and modules dict (lesson types with class numbers as lists).
+        Numeric class numbers are normalized without leading zeros ("07" -> "7").
     """
     parsed = urlparse(url)
     
     # Validate domain
-    if "nusmods.com" not in parsed.netloc:
+    # Exact host match, so look-alikes such as nusmods.com.example.net are rejected
+    hostname = parsed.hostname or ""
+    if hostname != "nusmods.com" and not hostname.endswith(".nusmods.com"):
         raise ValueError("Invalid URL: must be a nusmods.com URL")
     
     # Extract semester from path: /timetable/sem-2/share
     path_parts = parsed.path.strip("/").split("/")
     
-    if len(path_parts) < 2 or "sem-" not in path_parts[1]:
+    if len(path_parts) < 2 or not path_parts[1].startswith("sem-"):
         raise ValueError("Invalid URL: could not find semester in path")
     
-    semester_match = re.search(r"sem-(\d+)", path_parts[1])
-    if not semester_match:
+    semester_str = path_parts[1][4:]  # "sem-2" -> "2"
+    if not semester_str.isdecimal():
         raise ValueError("Invalid URL: could not parse semester number")
     
-    semester = int(semester_match.group(1))
+    semester = int(semester_str)
     logger.info(f"Parsed semester: {semester}")
     
-    # Parse query string
-    query = parse_qs(parsed.query)
+    # Parse query string (first occurrence of a repeated module wins)
+    query: dict[str, str] = {}
+    for module_code, lesson_str in parse_qsl(parsed.query):
+        query.setdefault(module_code, lesson_str)
     logger.info(f"Query parameters found: {list(query.keys())}")
     
     modules: dict[str, dict[str, list[str]]] = {}
-    for module_code, lessons_list in query.items():
-        if not lessons_list or not lessons_list[0]:
-            continue
-            
-        lesson_str = lessons_list[0]
+    for module_code, lesson_str in query.items():
         lesson_dict: dict[str, list[str]] = {}
         
         # Split by semicolon (new format) or comma (old format)
@@ -101,19 +156,20 @@ def parse_nusmods_url(url: str) -> ParsedUrl:
             lessons = lesson_str.split(",")
         
         for lesson in lessons:
-            if ":" not in lesson:
+            lesson_type, sep, class_no_raw = lesson.partition(":")
+            if not sep:
                 continue
-            lesson_type, class_no_raw = lesson.split(":", 1)
             
             # Remove parentheses: "(7)" -> "7", "(34,35)" -> "34,35"
             class_no_str = class_no_raw.strip("()")
             
-            # Parse class numbers (can be comma-separated for multiple sessions)
-            class_numbers = []
-            for num in class_no_str.split(","):
-                num = num.strip()
-                if num:
-                    class_numbers.append(num)
+            # Parse class numbers (can be comma-separated for multiple sessions),
+            # normalized once here so enrichment can compare by plain equality
+            class_numbers = [
+                _normalize_class_no(num)
+                for num in map(str.strip, class_no_str.split(","))
+                if num
+            ]
             
             if class_numbers:
                 # Keep abbreviated type for now, we'll map it in enrichment
@@ -121,7 +177,7 @@ def parse_nusmods_url(url: str) -> ParsedUrl:
         
         if lesson_dict:
             modules[module_code.upper()] = lesson_dict
-            logger.info(f"Parsed module {module_code.upper()}: {lesson_dict}")
+            logger.debug("Parsed module %s: %s", module_code.upper(), lesson_dict)
     
     logger.info(f"Total modules parsed: {len(modules)}")
     return ParsedUrl(semester=semester, modules=modules)
@@ -135,22 +191,64 @@ def get_current_academic_year() -> str:
     - August to December: AY is current_year to next_year (e.g., Aug 2025 -> AY2025-2026)
     - January to July: AY is (current_year - 1) to current_year (e.g., Feb 2026 -> AY2025-2026)
     
+    The result is reused for ACADEMIC_YEAR_CACHE_SEC, since it only changes
+    once a year.
+    
     Returns:
         Academic year string in format "YYYY-YYYY" (e.g., "2025-2026")
     """
+    global _academic_year_cache
+    
+    cached = _academic_year_cache
+    if cached is not None and time.monotonic() - cached[1] < ACADEMIC_YEAR_CACHE_SEC:
+        return cached[0]
+    
     now = datetime.now()
     current_year = now.year
     current_month = now.month
     
     if current_month >= 8:  # August onwards
-        return f"{current_year}-{current_year + 1}"
+        academic_year = f"{current_year}-{current_year + 1}"
     else:  # January to July
-        return f"{current_year - 1}-{current_year}"
+        academic_year = f"{current_year - 1}-{current_year}"
+    
+    _academic_year_cache = (academic_year, time.monotonic())
+    return academic_year
+
+
+@functools.lru_cache(maxsize=MODULE_CACHE_SIZE)
+def _fetch_module_data_cached(module_code: str, academic_year: str, ttl_bucket: int) -> dict:
+    """
+    Fetch module JSON, memoized per (module, academic year, TTL window).
+    Raises on failure so that errors are never cached.
+    
+    Only the per-semester timetables are kept. The full document (description,
+    prerequisite trees, workload, ...) is dropped right after decoding so cache
+    entries stay small.
+    """
+    # Use general module endpoint
+    url = f"https://api.nusmods.com/v2/{academic_year}/modules/{module_code}.json"
+    
+    logger.info(f"Fetching module data: {module_code} from {url}")
+    response = _SESSION.get(url, timeout=10)
+    response.raise_for_status()
+    data = _json_loads(response.content)
+    
+    return {
+        "semesterData": [
+            {"semester": sem_data.get("semester"), "timetable": sem_data.get("timetable", [])}
+            for sem_data in data.get("semesterData", [])
+        ]
+    }
 
 
 def fetch_module_data(module_code: str, academic_year: str, semester: int) -> Optional[dict]:
     """
-    Fetch module data from NUSMods API.
+    Fetch module data from NUSMods API, served from an in-process cache when
+    the module was fetched within the last MODULE_CACHE_TTL_SEC.
+    
+    The general module endpoint covers all semesters, so the cache is shared
+    across semesters; callers filter semesterData themselves.
     
     Args:
         module_code: Module code (e.g., "CS2040")
@@ -158,198 +256,162 @@ def fetch_module_data(module_code: str, academic_year: str, semester: int) -> Op
         semester: Semester number (1 or 2)
     
     Returns:
-        Module data dict with semesterData containing lessons, or None if failed
+        Dict with a semesterData list of {semester, timetable}, or None if failed
     """
-    url = f"https://api.nusmods.com/v2/{academic_year}/semesters/{semester}/modules/{module_code}.json"
-    
+    ttl_bucket = int(time.time() // MODULE_CACHE_TTL_SEC)
     try:
-        logger.info(f"Fetching module data: {module_code} from {url}")
-        response = requests.get(url, timeout=10)
-        # Handle 404 cleanly - API might return 404 if year/sem/module combo is wrong
-        if response.status_code == 404:
-             # Try fallback to module detail only key if semester specific fails (though structure differs)
-             # But for v2 API, the endpoint above is standard. 
-             # Let's just try the general module endpoint if the semester specific one fails,
-             # though that returns all semesters and we need to filter.
-             # Actually, simpler to stick to standard endpoint and return None on 404 for now.
-             logger.warning(f"Module data not found for {module_code} (404)")
-             return None
-             
-        response.raise_for_status()
-        data = response.json()
-        
-        # Log what we got back
-        if "semesterData" in data:
-            timetable_count = len(data["semesterData"].get("timetable", []))
-            logger.info(f"Successfully fetched {module_code}: {timetable_count} timetable entries found")
-        else:
-            # Maybe the general endpoint was hit? try to find correct semester
-            # The semester endpoint returns the module object but semesterData is a list if using general endpoint?
-            # Wait, https://api.nusmods.com/v2/{year}/semesters/{sem}/modules/{code}.json returns object where semesterData IS the data for that sem?
-            # Actually no, checking the response from `curl` earlier.. 
-            # The curl command used was /modules/{code}.json (general) which returns "semesterData": [ {semester: 1, ...}, {semester: 2, ...} ]
-            # The endpoint /semesters/{sem}/modules/{code}.json returns just the module details *for that semester*?
-            # The v2 API verification showed we used the GENERAL endpoint in my manual test.
-            # Let's check if the code expects the general endpoint structure or specific.
-            # "semesterData" in data -> checking if key exists.
-            pass
-            
-        return data
-    except requests.exceptions.RequestException as e:
+        return _fetch_module_data_cached(module_code, academic_year, ttl_bucket)
+    except (requests.exceptions.RequestException, ValueError) as e:
         logger.warning(f"Failed to fetch module data for {module_code}: {str(e)}")
         return None
 
 
-def enrich_schedule_with_api_data(parsed_url: ParsedUrl) -> EnrichedSchedule:
+def _match_module_lessons(
+    module_code: str,
+    lesson_types: Dict[str, List[str]],
+    module_data: Optional[dict],
+    semester: int,
+) -> List[EnrichedLesson]:
     """
-    Enrich parsed URL data with actual schedule information from NUSMods API.
+    Select the lessons for one module's requested classes from its API data.
     
     Args:
-        parsed_url: Parsed URL data with semester and modules
+        module_code: Module code (e.g., "CS2040")
+        lesson_types: Requested class numbers keyed by URL lesson type, already
+            normalized by parse_nusmods_url
+        module_data: Module JSON from fetch_module_data, or None if the fetch failed
+        semester: Semester number (1 or 2)
     
     Returns:
-        Enriched schedule dict mapping module codes to lists of lesson details
+        Matching lessons, empty if the module or semester data is missing
     """
-    semester = parsed_url["semester"]
-    modules = parsed_url["modules"]
-    academic_year = get_current_academic_year()
+    logger.debug("Processing module %s: looking for %s", module_code, lesson_types)
+    module_lessons: List[EnrichedLesson] = []
     
-    logger.info(f"Enriching schedule data for AY{academic_year}, Semester {semester}")
+    if not module_data:
+        logger.warning(f"No data fetched for {module_code}, skipping")
+        return module_lessons
+        
+    # Find the correct semester data
+    semester_data = None
+    all_semesters = module_data.get("semesterData", [])
+    for sem_data in all_semesters:
+        if sem_data.get("semester") == semester:
+            semester_data = sem_data
+            break
+    
+    if not semester_data:
+        logger.warning(f"No data found for {module_code} in semester {semester}")
+        return module_lessons
+        
+    timetable = semester_data.get("timetable", [])
+    logger.debug("Module %s has %d lessons in timetable", module_code, len(timetable))
     
-    enriched_schedule: EnrichedSchedule = {}
+    # Resolve full lesson types from mapping (e.g., "LAB" -> "Laboratory").
+    # parse_nusmods_url already uppercases lesson types; unknown ones are used as is
+    api_lesson_types = {
+        url_lesson_type: LESSON_TYPE_MAPPING.get(url_lesson_type, url_lesson_type)
+        for url_lesson_type in lesson_types
+    }
+    requested_types = set(api_lesson_types.values())
+    requested_classes = {
+        (api_lesson_types[url_lesson_type], class_no)
+        for url_lesson_type, class_numbers in lesson_types.items()
+        for class_no in class_numbers
+    }
     
-    for module_code, lesson_types in modules.items():
-        logger.info(f"Processing module {module_code}: looking for {lesson_types}")
-        enriched_schedule[module_code] = []
+    # Index the requested lessons once by (lesson type, normalized class number).
+    # Most of a module's timetable is other classes, which are skipped early.
+    # A single class (e.g. "LEC 1") can have several slots (Mon + Wed), so each
+    # key holds a list.
+    lessons_by_class: Dict[tuple, List[dict]] = defaultdict(list)
+    for lesson in timetable:
+        lesson_type = lesson.get("lessonType")
+        if lesson_type not in requested_types:
+            continue
+        key = (lesson_type, _normalize_class_no(str(lesson.get("classNo", "")).strip()))
+        if key in requested_classes:
+            lessons_by_class[key].append(lesson)
+    
+    for url_lesson_type, class_numbers in lesson_types.items():
+        api_lesson_type = api_lesson_types[url_lesson_type]
         
-        # Fetch module data from NUSMods API
-        module_data = fetch_module_data(module_code, academic_year, semester)
+        logger.debug(
+            "Looking for %s %s (API: %s) classes: %s",
+            module_code, url_lesson_type, api_lesson_type, class_numbers
+        )
         
-        if not module_data:
-             logger.warning(f"Could not fetch data for {module_code}")
-             continue
-
-        # Handle different API response structures (General vs Semester-Specific Endpoint)
-        # The URL used in fetch_module_data suggests semester-specific endpoint? 
-        # Actually checking docs/usage: v2 API has /modules/{code}.json which contains all semesters.
-        # The fetch_module_data function uses /semesters/{sem}/modules/{code}.json pattern which might NOT exist?
-        # Let's check the earlier CURL: 
-        # curl -s "https://api.nusmods.com/v2/2025-2026/semesters/2/modules/BT2102.json" -> 404
-        # curl -s "https://api.nusmods.com/v2/2025-2026/modules/BT2102.json" -> 200 OK
-        # So we MUST use the general endpoint and filter by semester manually.
-
-    # Enrich the schedule with API data
-    enriched_schedule = enrich_schedule_with_api_data(parsed_url)
-    
-    return enriched_schedule
-
-
-def fetch_module_data(module_code: str, academic_year: str, semester: int) -> Optional[dict]:
-    # Use general module endpoint
-    url = f"https://api.nusmods.com/v2/{academic_year}/modules/{module_code}.json"
+        matches_found = 0
+        
+        for class_no_target in class_numbers:
+            matching_lessons = lessons_by_class.get((api_lesson_type, class_no_target), ())
+            
+            if not matching_lessons:
+                logger.warning(f"✗ No match found for {module_code} {url_lesson_type} class {class_no_target}")
+                continue
+            
+            # Emit every slot of the class at once
+            lesson_type_name = sys.intern(api_lesson_type)
+            module_lessons.extend(
+                EnrichedLesson(
+                    day=sys.intern(lesson.get("day", "TBA")),
+                    startTime=lesson.get("startTime", "TBA"),
+                    endTime=lesson.get("endTime", "TBA"),
+                    venue=sys.intern(lesson.get("venue", "TBA")),
+                    lessonType=lesson_type_name,
+                    classNo=str(lesson.get("classNo", "")).strip()
+                )
+                for lesson in matching_lessons
+            )
+            matches_found += len(matching_lessons)
+            logger.debug(
+                "✓ Matched: %s %s %s -> %s (%d slots)",
+                module_code, url_lesson_type, class_no_target, api_lesson_type, len(matching_lessons)
+            )
+        
+        logger.debug("Found %d lessons for %s %s", matches_found, module_code, url_lesson_type)
     
-    try:
-        logger.info(f"Fetching module data: {module_code} from {url}")
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        return data
-    except requests.exceptions.RequestException as e:
-        logger.warning(f"Failed to fetch module data for {module_code}: {str(e)}")
-        return None
+    return module_lessons
 
 
 def enrich_schedule_with_api_data(parsed_url: ParsedUrl) -> EnrichedSchedule:
+    """
+    Enrich parsed URL data with actual schedule information from NUSMods API.
+    
+    Args:
+        parsed_url: Parsed URL data with semester and modules
+    
+    Returns:
+        Enriched schedule dict mapping module codes to lists of lesson details
+    """
     semester = parsed_url["semester"]
     modules = parsed_url["modules"]
     academic_year = get_current_academic_year()
     
     logger.info(f"Enriching schedule data for AY{academic_year}, Semester {semester}")
     
-    enriched_schedule: EnrichedSchedule = {}
+    # Pre-seed keys so the result keeps the URL's module order
+    enriched_schedule: EnrichedSchedule = {module_code: [] for module_code in modules}
+    total_lessons = 0
     
-    for module_code, lesson_types in modules.items():
-        logger.info(f"Processing module {module_code}: looking for {lesson_types}")
-        enriched_schedule[module_code] = []
-        
-        module_data = fetch_module_data(module_code, academic_year, semester)
-        
-        if not module_data:
-            logger.warning(f"No data fetched for {module_code}, skipping")
-            continue
-            
-        # Find the correct semester data
-        semester_data = None
-        all_semesters = module_data.get("semesterData", [])
-        for sem_data in all_semesters:
-            if sem_data.get("semester") == semester:
-                semester_data = sem_data
-                break
-        
-        if not semester_data:
-            logger.warning(f"No data found for {module_code} in semester {semester}")
-            continue
-            
-        timetable = semester_data.get("timetable", [])
-        logger.info(f"Module {module_code} has {len(timetable)} lessons in timetable")
-        
-        for url_lesson_type, class_numbers in lesson_types.items():
-            # Resolve full lesson type from mapping (e.g., "LAB" -> "Laboratory")
-            # If not in mapping, try title case as fallback (e.g. "Lec" -> "Lecture"?)
-            # Or just use as is if not found
-            api_lesson_type = LESSON_TYPE_MAPPING.get(url_lesson_type.upper(), url_lesson_type)
-            
-            logger.info(f"Looking for {module_code} {url_lesson_type} (API: {api_lesson_type}) classes: {class_numbers}")
-            
-            matches_found = 0
-            
-            for class_no_target in class_numbers:
-                found_match = False
-                class_no_target_str = str(class_no_target).strip()
-                
-                for lesson in timetable:
-                    # Check Lesson Type match
-                    current_lesson_type = lesson.get("lessonType")
-                    if current_lesson_type != api_lesson_type:
-                        continue
-                        
-                    # Check Class Number match
-                    # Valid matches: "1" == "1", "01" == "1", "1" == "01"
-                    current_class_no = str(lesson.get("classNo", "")).strip()
-                    
-                    is_match = False
-                    if current_class_no == class_no_target_str:
-                        is_match = True
-                    else:
-                        # Try integer comparison if both look like integers
-                        try:
-                            if int(current_class_no) == int(class_no_target_str):
-                                is_match = True
-                        except ValueError:
-                            pass # Not integers
-                            
-                    if is_match:
-                        enriched_lesson = EnrichedLesson(
-                            day=lesson.get("day", "TBA"),
-                            startTime=lesson.get("startTime", "TBA"),
-                            endTime=lesson.get("endTime", "TBA"),
-                            venue=lesson.get("venue", "TBA"),
-                            lessonType=current_lesson_type,
-                            classNo=current_class_no
-                        )
-                        enriched_schedule[module_code].append(enriched_lesson)
-                        logger.info(f"✓ Matched: {module_code} {url_lesson_type} {class_no_target} -> {current_lesson_type} {current_class_no}")
-                        matches_found += 1
-                        found_match = True
-                        # Don't break here! A single class number (e.g. "LEC 1") might have multiple slots (Mon key + Wed key)
-                        # We want all of them.
-                
-                if not found_match:
-                    logger.warning(f"✗ No match found for {module_code} {url_lesson_type} class {class_no_target}")
-            
-            logger.info(f"Found {matches_found} lessons for {module_code} {url_lesson_type}")
+    # Fetch every module concurrently; each request is dominated by network RTT.
+    # Modules are matched as their data arrives while the rest are in flight.
+    futures = {
+        _FETCH_EXECUTOR.submit(fetch_module_data, module_code, academic_year, semester): module_code
+        for module_code in modules
+    }
+    try:
+        for future in as_completed(futures):
+            module_code = futures[future]
+            module_lessons = _match_module_lessons(
+                module_code, modules[module_code], future.result(), semester
+            )
+            enriched_schedule[module_code] = module_lessons
+            total_lessons += len(module_lessons)
+    finally:
+        # On an unexpected error, drop fetches that have not started yet
+        for future in futures:
+            future.cancel()
             
-    total_lessons = sum(len(lessons) for lessons in enriched_schedule.values())
     logger.info(f"Total lessons enriched across all modules: {total_lessons}")
     return enriched_schedule
-
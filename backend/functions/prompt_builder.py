@@ -5,8 +5,11 @@ Constructs optimized text-to-image prompts for Imagen 4.0 Ultra to generate
 NUSMods timetable phone wallpapers with iPhone-specific layout constraints.
 """
 
-from typing import Literal, Dict, List, Any, Optional
+from typing import Literal, Dict, List, Any, Optional, Tuple
+import functools
 import logging
+import operator
+import string
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -68,75 +71,196 @@ STYLE_DESCRIPTIONS = {
     },
 }
 
+# (design_style, theme) -> (display name, description), resolved once at import
+_STYLE_INDEX: Dict[Tuple[str, str], Tuple[str, str]] = {
+    (style, theme): (f"{style.capitalize()} ({theme.capitalize()} Mode)", desc)
+    for style, themes in STYLE_DESCRIPTIONS.items()
+    for theme, desc in themes.items()
+}
+_DEFAULT_STYLE = _STYLE_INDEX[("minimalist", "light")]
+
 # ---------------------------------------------------------------------------
 # DATA FORMATTING
 # ---------------------------------------------------------------------------
-def format_schedule_data(enriched_schedule: Any) -> str:
+# Sort rank per weekday; unrecognised day strings sort last
+_DAY_RANK = {
+    "Monday": 0, "Tuesday": 1, "Wednesday": 2, "Thursday": 3,
+    "Friday": 4, "Saturday": 5, "Sunday": 6,
+}
+_UNKNOWN_DAY_RANK = 99
+
+
+def _format_time(hhmm: str) -> str:
+    """Format "HHMM" as "HH:MM"; other strings are returned unchanged."""
+    return f"{hhmm[:2]}:{hhmm[2:]}" if len(hhmm) == 4 else hhmm
+
+
+# Every valid "HHMM" clock time (1440 entries), looked up instead of sliced
+_TIME_FMT = {
+    hhmm: _format_time(hhmm)
+    for hhmm in (f"{h:02d}{m:02d}" for h in range(24) for m in range(60))
+}
+
+
+NO_CLASSES_TEXT = "No classes scheduled."
+
+# Markdown lines, e.g. "## Monday" / "- **CS1010** (Lecture): 10:00-12:00 @ COM1"
+_DAY_HEADER_FMT = "\n## %s"
+_LESSON_LINE_FMT = "- **%s** (%s): %s @ %s"
+
+# One (module, day, startTime, endTime, venue, lessonType) tuple per lesson
+ScheduleKey = Tuple[Tuple[str, str, str, str, str, str], ...]
+
+
+# Lesson fields in ScheduleKey order, and the defaults used when one is missing
+_LESSON_FIELDS = operator.itemgetter("day", "startTime", "endTime", "venue", "lessonType")
+_LESSON_DEFAULTS = {
+    "day": "TBA", "startTime": "0000", "endTime": "0000",
+    "venue": "TBA", "lessonType": "Class",
+}
+
+
+def _schedule_key(enriched_schedule: Any) -> ScheduleKey:
     """
-    Format schedule into a structured Markdown representation for the prompt.
+    Flatten a schedule into a hashable key, applying the field defaults.
     """
-    if not enriched_schedule:
-        return "No classes scheduled."
+    key = []
+    for module_code, lessons in enriched_schedule.items():
+        for lesson in lessons:
+            try:
+                fields = _LESSON_FIELDS(lesson)
+            except KeyError:
+                fields = _LESSON_FIELDS({**_LESSON_DEFAULTS, **lesson})
+            key.append((module_code, *fields))
+    return tuple(key)
+
+
+@functools.lru_cache(maxsize=32)
+def _format_schedule_cached(schedule_key: ScheduleKey) -> str:
+    """
+    Render a flattened schedule. Cached, since previewing every style/theme
+    for one timetable formats the same schedule repeatedly.
+    """
+    # Fast path: a single lesson needs no sorting or day grouping
+    if len(schedule_key) == 1:
+        (module_code, day, start, end, venue, l_type), = schedule_key
+        start = _TIME_FMT.get(start) or _format_time(start)
+        end = _TIME_FMT.get(end) or _format_time(end)
+        return "\n".join((
+            _DAY_HEADER_FMT % day,
+            _LESSON_LINE_FMT % (module_code, l_type, f"{start}-{end}", venue),
+        ))
 
     # Pre-processing: flatten list
     flat_lessons = []
     
-    # Map abbreviated lesson types to readable full names (if not already done by parser)
-    # But parser should have done it. We keep a fallback just in case.
-    LESSON_SCOPES = {
-        "LEC": "Lecture", "TUT": "Tutorial", "LAB": "Lab", 
-        "SEC": "Sectional", "REC": "Recitation"
-    }
+    for module_code, day, start, end, venue, l_type in schedule_key:
+        # Format Time
+        start = _TIME_FMT.get(start) or _format_time(start)
+        end = _TIME_FMT.get(end) or _format_time(end)
+        
+        # Sortable tuple: (day rank, time, insertion order, ...). The insertion
+        # order keeps same-slot lessons in schedule order and means the
+        # trailing fields are never compared.
+        time_range = f"{start}-{end}"
+        flat_lessons.append((
+            _DAY_RANK.get(day, _UNKNOWN_DAY_RANK), time_range, len(flat_lessons),
+            module_code, l_type, day, venue,
+        ))
 
-    days_order = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-    
-    for module_code, lessons in enriched_schedule.items():
-        for lesson in lessons:
-            day = lesson.get("day", "TBA")
-            start = lesson.get("startTime", "0000")
-            end = lesson.get("endTime", "0000")
-            venue = lesson.get("venue", "TBA")
-            l_type = lesson.get("lessonType", "Class")
-            
-            # Format Time
-            if len(start) == 4: start = f"{start[:2]}:{start[2:]}"
-            if len(end) == 4: end = f"{end[:2]}:{end[2:]}"
-            
-            # Shorten types for table compactness
-            l_type_short = LESSON_SCOPES.get(l_type, l_type.split(" ")[0]) 
-
-            flat_lessons.append({
-                "Module": module_code,
-                "Type": l_type,
-                "Day": day,
-                "Time": f"{start}-{end}",
-                "Venue": venue
-            })
-
-    # Sort by Day then Time
-    try:
-        flat_lessons.sort(key=lambda x: (days_order.index(x["Day"]) if x["Day"] in days_order else 99, x["Time"]))
-    except ValueError:
-        pass # Fallback if random day string
-
-    # Construct Markdown Table
-    md_output = []
+    # Sort by Day then Time. Unknown days already carry a fallback rank, so
+    # the tuple ordering is total and the sort cannot fail.
+    flat_lessons.sort()
+
+    # Construct Markdown Table. Every lesson can at most start a new day
+    # group, so two slots per lesson always suffice.
+    md_output: List[Optional[str]] = [None] * (2 * len(flat_lessons))
+    idx = 0
     current_day = ""
     
-    for l in flat_lessons:
+    for _, time_range, _, module_code, l_type, day, venue in flat_lessons:
         # Group visually by Day in the text
-        if l["Day"] != current_day:
-            md_output.append(f"\n## {l['Day']}")
-            current_day = l["Day"]
+        if day != current_day:
+            md_output[idx] = _DAY_HEADER_FMT % day
+            idx += 1
+            current_day = day
         
-        # Format: - [CS1010] Lecture: 10:00-12:00 @ COM1
-        md_output.append(f"- **{l['Module']}** ({l['Type']}): {l['Time']} @ {l['Venue']}")
+        md_output[idx] = _LESSON_LINE_FMT % (module_code, l_type, time_range, venue)
+        idx += 1
+
+    return "\n".join(md_output[:idx])
 
-    return "\n".join(md_output)
+
+def format_schedule_data(enriched_schedule: Any) -> str:
+    """
+    Format schedule into a structured Markdown representation for the prompt.
+    """
+    if not enriched_schedule:
+        return NO_CLASSES_TEXT
+
+    return _format_schedule_cached(_schedule_key(enriched_schedule))
 
 # ---------------------------------------------------------------------------
 # BUILDER FUNCTION
 # ---------------------------------------------------------------------------
+# The template is split once into (literal, field name) pairs, so rendering is a
+# str.join over plain strings with no format-spec parsing per call
+_TEMPLATE_PARTS: Tuple[Tuple[str, Optional[str]], ...] = tuple(
+    (literal, field_name)
+    for literal, field_name, _, _ in string.Formatter().parse(GENERATION_PROMPT_TEMPLATE)
+)
+
+
+@functools.lru_cache(maxsize=64)
+def _prompt_frame(design_style: str, theme: str, aspect_ratio: str) -> Tuple[str, str]:
+    """
+    Render the schedule-independent parts of the prompt.
+    Returns the text before and after the schedule table.
+    """
+    # 1. Get Style Description
+    style_full_name, style_desc = _STYLE_INDEX.get((design_style, theme), _DEFAULT_STYLE)
+
+    # 2. Render template around the schedule table slot
+    values = {
+        "aspect_ratio": aspect_ratio,
+        "style_name": style_full_name,
+        "style_description": style_desc,
+    }
+    head: List[str] = []
+    tail: List[str] = []
+    parts = head
+    for literal, field_name in _TEMPLATE_PARTS:
+        parts.append(literal)
+        if field_name == "schedule_table":
+            parts = tail
+        elif field_name is not None:
+            parts.append(values[field_name])
+    return "".join(head), "".join(tail)
+
+
+@functools.lru_cache(maxsize=64)
+def _build_prompt_cached(
+    design_style: str,
+    theme: str,
+    aspect_ratio: str,
+    schedule_key: Optional[ScheduleKey],
+) -> str:
+    """
+    Assemble the prompt; schedule_key is None when there is no schedule.
+    """
+    # 1. Resolve the cached style/theme frame
+    head, tail = _prompt_frame(design_style, theme, aspect_ratio)
+
+    # 2. Format Schedule
+    if schedule_key is None:
+        schedule_table = NO_CLASSES_TEXT
+    else:
+        schedule_table = _format_schedule_cached(schedule_key)
+
+    # 3. Assemble Prompt
+    return head + schedule_table + tail
+
+
 def build_prompt(
     design_style: DesignStyleType = "minimalist",
     theme: ThemeType = "light",
@@ -146,21 +270,37 @@ def build_prompt(
     """
     Build the text-to-image prompt.
     """
-    # 1. Get Style Description
-    style_category = STYLE_DESCRIPTIONS.get(design_style, STYLE_DESCRIPTIONS["minimalist"])
-    style_desc = style_category.get(theme, style_category["light"])
-    style_full_name = f"{design_style.capitalize()} ({theme.capitalize()} Mode)"
+    schedule_key = _schedule_key(enriched_schedule) if enriched_schedule else None
+    prompt = _build_prompt_cached(design_style, theme, aspect_ratio, schedule_key)
 
-    # 2. Format Schedule
-    schedule_table = format_schedule_data(enriched_schedule)
-    
-    # 3. Assemble Prompt
-    prompt = GENERATION_PROMPT_TEMPLATE.format(
-        aspect_ratio=aspect_ratio,
-        schedule_table=schedule_table,
-        style_name=style_full_name,
-        style_description=style_desc
-    )
-
-    logger.info(f"Generated Prompt ({len(prompt)} chars) for {design_style} {theme}")
+    logger.info("Generated Prompt (%d chars) for %s %s", len(prompt), design_style, theme)
     return prompt
+
+
+def build_prompts_batch(
+    specs: List[Tuple[DesignStyleType, ThemeType, str, Optional[Any]]],
+) -> List[str]:
+    """
+    Build several prompts at once, e.g. every style preview for one timetable.
+    
+    Args:
+        specs: (design_style, theme, aspect_ratio, enriched_schedule) tuples
+    
+    Returns:
+        Prompts in the same order as specs
+    """
+    # A schedule shared by several specs is flattened only once
+    schedule_keys: Dict[int, Optional[ScheduleKey]] = {}
+    prompts = []
+    for design_style, theme, aspect_ratio, enriched_schedule in specs:
+        schedule_id = id(enriched_schedule)
+        if schedule_id not in schedule_keys:
+            schedule_keys[schedule_id] = (
+                _schedule_key(enriched_schedule) if enriched_schedule else None
+            )
+        prompts.append(
+            _build_prompt_cached(design_style, theme, aspect_ratio, schedule_keys[schedule_id])
+        )
+
+    logger.info("Generated %d prompts in batch", len(prompts))
+    return prompts
@@ -1,13 +1,10 @@
 
 import logging
-import os
-import sys
 
-# Add the directory to sys.path so we can import functions
-sys.path.append(os.path.join(os.path.dirname(__file__), 'functions'))
-
-from functions.nusmods_parser import parse_nusmods_url, enrich_schedule_with_api_data
-from functions.prompt_builder import build_prompt
+# Run as a module from the repository root: python -m backend.verify_generation
+# (running the file directly fails, since "backend" is then not importable)
+from backend.functions.nusmods_parser import parse_nusmods_url, enrich_schedule_with_api_data
+from backend.functions.prompt_builder import build_prompt
 # We won't actually call image_generator in this script to save credits/time strictly unless needed, 
 # but we will print the prompt to verify it looks correct.
 
@@ -17,6 +14,9 @@ logger = logging.getLogger(__name__)
 
 TEST_URL = "https://nusmods.com/timetable/sem-2/share?BT2102=LEC:1&CS2040=LEC:1&MA1521=LEC:1&UTW1001T=SEC:1"
 
+# Critical keywords from the optimized template
+_REQUIRED_KEYWORDS = ("CRITICAL LAYOUT", "TOP 10%", "Minimalist (Light Mode)")
+
 def test_pipeline():
     logger.info("--- 1. Parsing URL ---")
     parsed_schedule = parse_nusmods_url(TEST_URL)
@@ -61,9 +61,8 @@ def test_pipeline():
     logger.info("------------------------")
     
     # Check for critical keywords from optimized template
-    assert "SAFE ZONES" in prompt
-    assert "TOP 25%" in prompt
-    assert "Minimalist (Light Mode)" in prompt
+    missing = [k for k in _REQUIRED_KEYWORDS if k not in prompt]
+    assert not missing, f"Prompt is missing keywords: {missing}"
     
     logger.info("✅ Verification Passed: Pipeline creates valid prompts from URL.")
 